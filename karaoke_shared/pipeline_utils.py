@@ -7,6 +7,7 @@ Added Redis Streams topics & helpers for event-driven pipelines:
   - STREAM_SPLIT_DONE
   - STREAM_PACKAGED
   - STREAM_ORGANIZED
+  - STREAM_NOTIFICATIONS (email alerts, drained by `drain_email_notifications`)
 
 Publish with `publish_*`, consume with `consume`.
 """
@@ -19,7 +20,10 @@ import smtplib
 from email.message import EmailMessage
 import traceback
 import datetime
+import random
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # -------- LOGGING SETUP --------
 LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
@@ -48,6 +52,8 @@ SMTP_USERNAME       = os.environ.get("SMTP_USERNAME")
 SMTP_PASSWORD       = os.environ.get("SMTP_PASSWORD")
 REDIS_HOST          = os.environ.get("REDIS_HOST", "redis")
 REDIS_PORT          = int(os.environ.get("REDIS_PORT", 6379))
+REDIS_POOL_SIZE     = int(os.environ.get("REDIS_POOL_SIZE", 32))
+STREAM_BATCH        = int(os.environ.get("STREAM_BATCH", 32))
 
 # -------- DIRECTORY CONFIG --------
 QUEUE_DIR  = os.environ.get("QUEUE_DIR", "/queue")
@@ -59,7 +65,32 @@ INPUT_DIR  = os.environ.get("INPUT_DIR", "/input")
 LOGS_DIR   = os.environ.get("LOGS_DIR", "/logs")
 
 # -------- REDIS CLIENT (singleton) --------
-redis_client = redis.Redis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+redis_pool = redis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    max_connections=REDIS_POOL_SIZE,
+    socket_timeout=5,
+    socket_connect_timeout=2,
+    socket_keepalive=True,
+    health_check_interval=30,
+    decode_responses=True,
+)
+redis_client = redis.Redis(connection_pool=redis_pool)
+
+# Blocking XREADGROUP calls wait server-side for up to `block` ms (0 = forever),
+# so they must not share the 5s read timeout above: a client-side timeout drops
+# the connection while the server may still deliver an entry to it.
+stream_pool = redis.BlockingConnectionPool(
+    host=REDIS_HOST,
+    port=REDIS_PORT,
+    max_connections=REDIS_POOL_SIZE,
+    socket_timeout=None,
+    socket_connect_timeout=2,
+    socket_keepalive=True,
+    health_check_interval=30,
+    decode_responses=True,
+)
+stream_client = redis.Redis(connection_pool=stream_pool)
 
 # -------- REDIS STREAM KEYS --------
 STREAM_QUEUED          = "stream:queued"
@@ -67,125 +98,343 @@ STREAM_METADATA_DONE   = "stream:metadata_done"
 STREAM_SPLIT_DONE      = "stream:split_done"
 STREAM_PACKAGED        = "stream:packaged"
 STREAM_ORGANIZED       = "stream:organized"
+STREAM_NOTIFICATIONS   = "stream:notifications"
+NOTIFICATIONS_MAXLEN   = 10000
 
 # -------- STRING SANITIZATION --------
+_CLEAN_TABLE = str.maketrans({"\x00": "", "/": "-", "\\": "-"})
+
 def clean_string(s):
     """Sanitize input for safe filesystem usage."""
     if not isinstance(s, str):
         s = str(s)
-    return s.replace("\x00", "").replace("/", "-").replace("\\", "-").strip()
+    return s.translate(_CLEAN_TABLE).strip()
 
 # -------- STATUS & ERROR MANAGEMENT (HASHES) --------
+# Each file:<name> hash is mirrored into a files:status:<status> set so
+# lookups by status never have to walk the keyspace.
+STATUS_INDEX_PREFIX = "files:status:"
+SCAN_BATCH = 500
+
+# Lua scripts keep a file's hash and its status set in step atomically, in one
+# round-trip. The index set names are derived from the stored status inside the
+# script, so they are not declared in KEYS: this is fine on a single Redis node
+# but not cluster-safe (file hashes and index sets must share a slot).
+_MOVE_STATUS_LUA = """
+local old = redis.call('HGET', KEYS[1], 'status')
+if old and old ~= ARGV[3] then
+    redis.call('SREM', ARGV[1] .. old, ARGV[2])
+end
+redis.call('SADD', ARGV[1] .. ARGV[3], ARGV[2])
+"""
+# KEYS[1] = file:<name>; ARGV = prefix, filename, status, then field/value
+# pairs for HSET. Returns the previous status.
+_SET_STATUS_LUA = _MOVE_STATUS_LUA + """
+redis.call('HSET', KEYS[1], unpack(ARGV, 4))
+return old
+"""
+# KEYS[1] = file:<name>, KEYS[2] = retries:<name>; ARGV = prefix, filename,
+# 'queued'. Requeues the file, drops its error and all retry counters.
+_CLEAR_ERROR_LUA = _MOVE_STATUS_LUA + """
+redis.call('HSET', KEYS[1], 'status', ARGV[3])
+redis.call('HDEL', KEYS[1], 'error')
+redis.call('DEL', KEYS[2])
+return old
+"""
+# register_script runs EVALSHA and falls back to loading the script on NOSCRIPT
+_set_status_script  = redis_client.register_script(_SET_STATUS_LUA)
+_clear_error_script = redis_client.register_script(_CLEAR_ERROR_LUA)
+
+def _status_index_key(status):
+    return f"{STATUS_INDEX_PREFIX}{status}"
+
+def _set_status(filename, value):
+    args = [STATUS_INDEX_PREFIX, filename, value["status"]]
+    for field, v in value.items():
+        args.extend((field, v))
+    return _set_status_script(keys=[f"file:{filename}"], args=args, client=redis_client)
+
 def set_file_status(filename, status, error=None, extra=None):
-    key = f"file:{filename}"
     value = {"status": status}
     if error:
         value["error"] = error
     if extra:
         value.update(extra)
     try:
-        redis_client.hset(key, mapping=value)
+        _set_status(filename, value)
     except Exception as e:
-        logger.error(f"Redis set_file_status error: {e}")
+        logger.error("Redis set_file_status error: %s", e)
 
 def get_files_by_status(status):
     try:
-        keys = redis_client.keys("file:*")
+        return list(redis_client.smembers(_status_index_key(status)))
     except Exception as e:
-        logger.error(f"Redis get_files_by_status error: {e}")
+        logger.error("Redis get_files_by_status error: %s", e)
         return []
-    out = []
+
+_REBUILD_PREFIX = "files:status_rebuild:"
+
+def _index_statuses(keys, statuses_seen):
+    """Fetch the status field of `keys` in one pipeline and add them to the rebuild sets."""
+    pipe = redis_client.pipeline(transaction=False)
     for key in keys:
-        try:
-            data = redis_client.hgetall(key)
-            if data.get("status") == status:
-                out.append(key.replace("file:", ""))
-        except Exception:
-            continue
-    return out
+        pipe.hget(key, "status")
+    statuses = pipe.execute(raise_on_error=False)
+    pipe = redis_client.pipeline(transaction=False)
+    for key, status in zip(keys, statuses):
+        # skip keys that are not hashes (WRONGTYPE) or have no status
+        if status and not isinstance(status, Exception):
+            pipe.sadd(f"{_REBUILD_PREFIX}{status}", key[len("file:"):])
+            statuses_seen.add(status)
+    pipe.execute(raise_on_error=False)
+
+def rebuild_status_index():
+    """
+    Rebuild every files:status:<status> set from the file:<name> hashes.
+    One-shot migration for data written before the index existed.
+    The new sets are built under temporary keys and renamed over the live
+    ones, so the index stays readable while the rebuild runs. Stop every
+    service that writes file statuses first: transitions made during the
+    scan are overwritten by the final rename.
+    """
+    try:
+        stale = list(redis_client.scan_iter(match=f"{_REBUILD_PREFIX}*", count=SCAN_BATCH))
+        if stale:
+            redis_client.delete(*stale)
+        statuses_seen = set()
+        chunk = []
+        for key in redis_client.scan_iter(match="file:*", count=SCAN_BATCH):
+            chunk.append(key)
+            if len(chunk) >= SCAN_BATCH:
+                _index_statuses(chunk, statuses_seen)
+                chunk = []
+        if chunk:
+            _index_statuses(chunk, statuses_seen)
+        live = set(redis_client.scan_iter(match=f"{STATUS_INDEX_PREFIX}*", count=SCAN_BATCH))
+        pipe = redis_client.pipeline(transaction=False)
+        for status in statuses_seen:
+            pipe.rename(f"{_REBUILD_PREFIX}{status}", _status_index_key(status))
+            live.discard(_status_index_key(status))
+        if live:
+            pipe.delete(*live)
+        pipe.execute()
+    except Exception as e:
+        logger.error("Redis rebuild_status_index error: %s", e)
 
 def set_file_error(filename, error):
     set_file_status(filename, "error", error=error)
 
 def clear_file_error(filename):
-    key = f"file:{filename}"
     try:
-        redis_client.hset(key, "status", "queued")
-        for stage in ["metadata", "splitter", "packager", "organizer"]:
-            redis_client.delete(f"{stage}_retries:{filename}")
-        redis_client.hdel(key, "error")
+        _clear_error_script(keys=[f"file:{filename}", _retry_key(filename)],
+                            args=[STATUS_INDEX_PREFIX, filename, "queued"],
+                            client=redis_client)
     except Exception as e:
-        logger.error(f"Redis clear_file_error error: {e}")
+        logger.error("Redis clear_file_error error: %s", e)
+
+# -------- CIRCUIT BREAKER --------
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures and short-circuits calls
+    for `cooldown` seconds. Once the cooldown expires the next call is let
+    through: success closes the breaker, failure re-opens it.
+    """
+
+    def __init__(self, name, threshold=5, cooldown=60):
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def is_open(self):
+        return self.state == "open"
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logger.warning("%s circuit opened after %s failures", self.name, self.failures)
+                self.opened_at = time.monotonic()
 
 # -------- NOTIFICATIONS --------
+# Shared keep-alive session so repeated notifications reuse TCP/TLS connections.
+_http = requests.Session()
+_http.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0))
+
+telegram_breaker = CircuitBreaker("Telegram")
+slack_breaker    = CircuitBreaker("Slack")
+email_breaker    = CircuitBreaker("Email")
+
 def send_telegram_message(message):
     if TELEGRAM_BOT_TOKEN and TELEGRAM_CHAT_ID:
+        if telegram_breaker.is_open():
+            logger.debug("Telegram skipped (circuit open)")
+            return
         url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
         data = {"chat_id": TELEGRAM_CHAT_ID, "text": message}
         try:
-            resp = requests.post(url, data=data, timeout=5)
-            if not resp.ok:
-                logger.warning(f"Telegram notification failed: {resp.text}")
+            resp = _http.post(url, data=data, timeout=5)
+            if resp.ok:
+                telegram_breaker.record_success()
+            else:
+                telegram_breaker.record_failure()
+                logger.warning("Telegram notification failed: %s", resp.text)
         except Exception as e:
-            logger.warning(f"Telegram notification error: {e}")
+            telegram_breaker.record_failure()
+            logger.warning("Telegram notification error: %s", e)
     else:
         logger.debug("Telegram skipped")
 
 def send_slack_message(message):
     if SLACK_WEBHOOK_URL:
+        if slack_breaker.is_open():
+            logger.debug("Slack skipped (circuit open)")
+            return
         try:
-            resp = requests.post(SLACK_WEBHOOK_URL, json={"text": message}, timeout=5)
-            if not resp.ok:
-                logger.warning(f"Slack notification failed: {resp.text}")
+            resp = _http.post(SLACK_WEBHOOK_URL, json={"text": message}, timeout=5)
+            if resp.ok:
+                slack_breaker.record_success()
+            else:
+                slack_breaker.record_failure()
+                logger.warning("Slack notification failed: %s", resp.text)
         except Exception as e:
-            logger.warning(f"Slack notification error: {e}")
+            slack_breaker.record_failure()
+            logger.warning("Slack notification error: %s", e)
     else:
         logger.debug("Slack skipped")
 
 def send_email(subject, message):
+    """
+    Queue an email alert on STREAM_NOTIFICATIONS. Delivery happens in
+    `drain_email_notifications`, which keeps one SMTP session open.
+    Skipped unless the full SMTP config is set, as the drainer needs it.
+    """
     if NOTIFY_EMAILS and SMTP_SERVER and SMTP_USERNAME and SMTP_PASSWORD:
         try:
-            msg = EmailMessage()
-            msg.set_content(message)
-            msg["Subject"] = subject
-            msg["From"]    = SMTP_USERNAME
-            msg["To"]      = [e.strip() for e in NOTIFY_EMAILS.split(",")]
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-                server.starttls()
-                server.login(SMTP_USERNAME, SMTP_PASSWORD)
-                server.send_message(msg)
+            redis_client.xadd(
+                STREAM_NOTIFICATIONS,
+                {"channel": "email", "subject": subject, "body": message},
+                maxlen=NOTIFICATIONS_MAXLEN,
+                approximate=True,
+            )
         except Exception as e:
-            logger.warning(f"Email notification error: {e}")
+            logger.warning("Email notification error: %s", e)
     else:
         logger.debug("Email skipped")
 
+# Notifications are dispatched off the pipeline thread; one worker per channel.
+# At most NOTIFY_BACKLOG sends may be queued or running; beyond that new ones
+# are dropped, so an error storm against slow endpoints cannot pile up
+# unbounded work (and interpreter shutdown waits on at most that many).
+NOTIFY_BACKLOG = int(os.environ.get("NOTIFY_BACKLOG", 100))
+_notify_pool = ThreadPoolExecutor(max_workers=3, thread_name_prefix="notify")
+_notify_slots = threading.BoundedSemaphore(NOTIFY_BACKLOG)
+
+def _run_notification(fn, *args):
+    try:
+        fn(*args)
+    finally:
+        _notify_slots.release()
+
+def _submit_notification(fn, *args):
+    if not _notify_slots.acquire(blocking=False):
+        logger.warning("Notification backlog full, dropping %s", fn.__name__)
+        return None
+    try:
+        return _notify_pool.submit(_run_notification, fn, *args)
+    except Exception as e:
+        # e.g. RuntimeError once the executor has shut down at interpreter exit
+        _notify_slots.release()
+        logger.warning("Could not dispatch %s: %s", fn.__name__, e)
+        return None
+
 def notify_all(subject, message):
-    send_telegram_message(message)
-    send_slack_message(message)
-    send_email(subject, message)
+    """
+    Fire all notification channels in parallel without blocking the caller.
+    Returns the futures for callers that need to wait on delivery; channels
+    dropped because the backlog is full are left out.
+    """
+    futures = [
+        _submit_notification(send_telegram_message, message),
+        _submit_notification(send_slack_message, message),
+        _submit_notification(send_email, subject, message),
+    ]
+    return [f for f in futures if f is not None]
 
 # -------- RETRY UTILITIES --------
+# All retry counters for a file live in one hash: retries:<filename> -> {stage: count}
+def _retry_key(filename):
+    return f"retries:{filename}"
+
 def get_retry_count(stage, filename):
     try:
-        return int(redis_client.get(f"{stage}_retries:{filename}") or 0)
+        return int(redis_client.hget(_retry_key(filename), stage) or 0)
     except:
         return 0
 
 def increment_retry(stage, filename):
-    cnt = get_retry_count(stage, filename) + 1
     try:
-        redis_client.set(f"{stage}_retries:{filename}", cnt)
-    except:
-        pass
-    return cnt
+        return redis_client.hincrby(_retry_key(filename), stage, 1)
+    except Exception as e:
+        logger.error("Redis increment_retry error: %s", e)
+        return get_retry_count(stage, filename) + 1
 
 def reset_retry(stage, filename):
     try:
-        redis_client.delete(f"{stage}_retries:{filename}")
+        redis_client.hdel(_retry_key(filename), stage)
     except:
         pass
 
-def handle_auto_retry(stage, filename, func, max_retries=3, retry_delay=5, notify_fail=True):
+LEGACY_RETRY_STAGES = ("metadata", "splitter", "packager", "organizer")
+
+def cleanup_legacy_retry_keys(stages=LEGACY_RETRY_STAGES):
+    """
+    Delete the per-stage <stage>_retries:<filename> counters used before
+    retries moved to retries:<filename> hashes. One-shot migration.
+    Only the given pipeline stages are touched. Returns the number of keys removed.
+    """
+    removed = 0
+    try:
+        for stage in stages:
+            chunk = []
+            for key in redis_client.scan_iter(match=f"{stage}_retries:*", count=SCAN_BATCH):
+                chunk.append(key)
+                if len(chunk) >= SCAN_BATCH:
+                    removed += redis_client.delete(*chunk)
+                    chunk = []
+            if chunk:
+                removed += redis_client.delete(*chunk)
+    except Exception as e:
+        logger.error("Redis cleanup_legacy_retry_keys error: %s", e)
+    return removed
+
+def backoff_delay(attempt, retry_delay=5, max_delay=300.0, jitter=1.0):
+    """
+    Exponential backoff for `attempt` (1-based), capped at `max_delay`.
+    `jitter` is the randomized fraction of the delay: 1.0 is full jitter,
+    0.0 is plain exponential backoff.
+    """
+    cap = min(retry_delay * (2 ** (attempt - 1)), max_delay)
+    return cap * (1 - jitter) + random.uniform(0, cap * jitter)
+
+def handle_auto_retry(stage, filename, func, max_retries=3, retry_delay=5, notify_fail=True,
+                      max_delay=300.0, jitter=1.0):
     for attempt in range(1, max_retries + 1):
         try:
             result = func()
@@ -193,16 +442,18 @@ def handle_auto_retry(stage, filename, func, max_retries=3, retry_delay=5, notif
             return result
         except Exception as e:
             retries = increment_retry(stage, filename)
+            logger.error("%s error on %s (attempt %s): %s", stage, filename, retries, e)
+            if attempt < max_retries:
+                # intermediate failures stay local; only the terminal one is recorded
+                logger.debug("%s traceback for %s", stage, filename, exc_info=True)
+                time.sleep(backoff_delay(attempt, retry_delay, max_delay, jitter))
+                continue
             tb = traceback.format_exc()
             timestamp = datetime.datetime.now().isoformat()
             set_file_error(filename, f"{timestamp}\n{e}\n{tb}")
-            logger.error(f"{stage} error on {filename} (attempt {retries}): {e}")
-            if attempt < max_retries:
-                time.sleep(retry_delay)
-            elif notify_fail:
+            if notify_fail:
                 notify_all(f"Pipeline Error [{stage}]", f"{stage} FAILED: {filename}\n{e}\n{tb}")
-            if attempt == max_retries:
-                raise
+            raise
 
 # -------- FILE STATUS SUMMARY --------
 def get_file_status(filename):
@@ -218,37 +469,189 @@ def get_file_status(filename):
         return {"filename": filename, "status": "unknown", "last_error": str(e)}
 
 # -------- REDIS STREAM HELPERS --------
-def ensure_consumer_group(stream_key: str, group_name: str):
-    """Create consumer group if it doesn’t already exist."""
+def ensure_consumer_group(stream_key: str, group_name: str, id: str = "$"):
+    """
+    Create consumer group if it doesn’t already exist.
+    The default id "$" only delivers entries added after creation; pass
+    id="0" to also deliver everything already in the stream.
+    """
     try:
-        redis_client.xgroup_create(stream_key, group_name, id="$", mkstream=True)
+        redis_client.xgroup_create(stream_key, group_name, id=id, mkstream=True)
     except redis.exceptions.ResponseError as e:
         # ignore “BUSYGROUP” if already created
         if "BUSYGROUP" not in str(e):
-            logger.error(f"Error creating group {group_name} on {stream_key}: {e}")
+            logger.error("Error creating group %s on %s: %s", group_name, stream_key, e)
+
+def ensure_consumer_groups(pairs):
+    """Create consumer groups for (stream_key, group_name) pairs in a single round-trip."""
+    pairs = list(pairs)
+    pipe = redis_client.pipeline(transaction=False)
+    for stream_key, group_name in pairs:
+        pipe.xgroup_create(stream_key, group_name, id="$", mkstream=True)
+    try:
+        results = pipe.execute(raise_on_error=False)
+    except Exception as e:
+        logger.error("Error creating consumer groups: %s", e)
+        return
+    for (stream_key, group_name), result in zip(pairs, results):
+        # ignore “BUSYGROUP” if already created
+        if isinstance(result, Exception) and "BUSYGROUP" not in str(result):
+            logger.error("Error creating group %s on %s: %s", group_name, stream_key, result)
 
 def publish(stream_key: str, filename: str):
     """Add a message {'filename':filename} to the given stream."""
     try:
         redis_client.xadd(stream_key, {"filename": filename})
     except Exception as e:
-        logger.error(f"Error publishing to {stream_key}: {e}")
+        logger.error("Error publishing to %s: %s", stream_key, e)
+
+def publish_many(stream_key: str, filenames):
+    """Add one {'filename':filename} message per filename in a single round-trip."""
+    publish_many_fields(stream_key, [{"filename": fn} for fn in filenames])
+
+def publish_many_fields(stream_key: str, payloads):
+    """Add one message per field dict in `payloads` in a single round-trip."""
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for fields in payloads:
+            pipe.xadd(stream_key, fields)
+        pipe.execute()
+    except Exception as e:
+        logger.error("Error publishing to %s: %s", stream_key, e)
+
+def _read_group(stream_key, group_name, consumer_name, last_id=">", block=0,
+                count=STREAM_BATCH, noack=False):
+    """XREADGROUP one stream; returns list of (msg_id, data_dict) and lets errors propagate."""
+    entries = stream_client.xreadgroup(group_name, consumer_name,
+                                       {stream_key: last_id}, block=block, count=count,
+                                       noack=noack)
+    # entries is [(stream_key, [(id, {'filename': '...'}), ...])]; already decoded
+    if not entries:
+        return []
+    _, msgs = entries[0]
+    return [(msg_id, data or {}) for msg_id, data in msgs]
 
 def consume(stream_key: str, group_name: str, consumer_name: str,
-            block: int = 0, count: int = 1):
+            block: int = 0, count: int = STREAM_BATCH, noack: bool = False,
+            last_id: str = ">"):
     """
     Read next message(s) from a stream consumer-group.
     Returns list of (msg_id, data_dict).
+    With noack=True messages are not added to the pending list, so they
+    need no XACK (at-most-once delivery).
+    Pass last_id="0" to re-read this consumer's own pending messages
+    instead of new ones; entries trimmed from the stream come back with
+    empty data.
     """
     try:
-        entries = redis_client.xreadgroup(group_name, consumer_name,
-                                          {stream_key: ">"}, block=block, count=count)
-        # entries is [(stream_key, [(id, {b'filename': '...'}), ...])]
-        if not entries:
-            return []
-        _, msgs = entries[0]
-        return [(msg_id, {k.decode(): v for k, v in data.items()})
-                for msg_id, data in msgs]
+        return _read_group(stream_key, group_name, consumer_name, last_id, block, count, noack)
     except Exception as e:
-        logger.error(f"Error consuming from {stream_key}: {e}")
+        logger.error("Error consuming from %s: %s", stream_key, e)
         return []
+
+def ack_many(stream_key: str, group_name: str, ids):
+    """Acknowledge a batch of message ids returned by `consume`."""
+    ids = list(ids)
+    if not ids:
+        return
+    try:
+        redis_client.xack(stream_key, group_name, *ids)
+    except Exception as e:
+        logger.error("Error acknowledging on %s: %s", stream_key, e)
+
+# -------- EMAIL DRAINER --------
+def _smtp_connect():
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=30)
+    server.starttls()
+    server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    return server
+
+def _smtp_close(server):
+    try:
+        server.quit()
+    except Exception:
+        pass
+
+def drain_email_notifications(group_name="email", consumer_name="email-drainer", block=2000,
+                              stop=None, max_attempts=5):
+    """
+    Send queued email alerts from STREAM_NOTIFICATIONS over a single,
+    persistent SMTP connection. Runs until `stop` (a threading.Event) is
+    set, or forever; meant for one dedicated worker.
+    Messages are acked only once sent. On startup and after a failure the
+    consumer's own pending messages are retried before new ones are read;
+    a message the SMTP server rejects `max_attempts` times is dropped.
+    """
+    if not (NOTIFY_EMAILS and SMTP_SERVER and SMTP_USERNAME and SMTP_PASSWORD):
+        logger.warning("Email drainer not started: SMTP settings missing")
+        return
+    recipients = [e.strip() for e in NOTIFY_EMAILS.split(",")]
+    # start from the beginning so alerts queued before the group existed are sent
+    ensure_consumer_group(STREAM_NOTIFICATIONS, group_name, id="0")
+    server = None
+    recovering = True
+    read_errors = 0
+    attempts = {}
+    while stop is None or not stop.is_set():
+        if email_breaker.is_open():
+            time.sleep(1)
+            continue
+        try:
+            if recovering:
+                msgs = _read_group(STREAM_NOTIFICATIONS, group_name, consumer_name, last_id="0")
+            else:
+                msgs = _read_group(STREAM_NOTIFICATIONS, group_name, consumer_name, block=block)
+            read_errors = 0
+        except Exception as e:
+            # Redis unreachable: back off instead of spinning on instant failures
+            read_errors += 1
+            logger.error("Error consuming from %s: %s", STREAM_NOTIFICATIONS, e)
+            time.sleep(backoff_delay(read_errors, retry_delay=block / 1000, max_delay=30))
+            continue
+        if recovering and not msgs:
+            recovering = False
+            continue
+        if msgs and server is not None:
+            # the server may have dropped an idle session since the last batch
+            try:
+                server.noop()
+            except Exception:
+                _smtp_close(server)
+                server = None
+        sent = []
+        sending = None
+        try:
+            for msg_id, data in msgs:
+                if data.get("channel") == "email":
+                    if server is None:
+                        server = _smtp_connect()
+                    msg = EmailMessage()
+                    msg.set_content(data.get("body", ""))
+                    msg["Subject"] = data.get("subject", "")
+                    msg["From"]    = SMTP_USERNAME
+                    msg["To"]      = recipients
+                    # only failures while sending count against the message,
+                    # not connection failures
+                    sending = msg_id
+                    server.send_message(msg)
+                    sending = None
+                    attempts.pop(msg_id, None)
+                sent.append(msg_id)
+            if sent:
+                email_breaker.record_success()
+        except Exception as e:
+            email_breaker.record_failure()
+            logger.warning("Email notification error: %s", e)
+            recovering = True
+            if sending is not None:
+                attempts[sending] = attempts.get(sending, 0) + 1
+                if attempts[sending] >= max_attempts:
+                    logger.error("Dropping email %s after %s failed attempts: %s",
+                                 sending, attempts.pop(sending), e)
+                    sent.append(sending)
+            if server is not None:
+                _smtp_close(server)
+                server = None
+        ack_many(STREAM_NOTIFICATIONS, group_name, sent)
+    if server is not None:
+        _smtp_close(server)
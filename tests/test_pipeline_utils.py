@@ -1,3 +1,7 @@
+import threading
+import time
+from unittest import mock
+
 import pytest
 from karaoke_shared import pipeline_utils
 
@@ -6,4 +10,178 @@ def test_clean_string_basic():
     assert pipeline_utils.clean_string("white space ") == "white space"
     assert pipeline_utils.clean_string("\x00foo") == "foo"
 
+def test_backoff_delay_bounds():
+    for attempt in range(1, 8):
+        cap = min(5 * (2 ** (attempt - 1)), 60)
+        delay = pipeline_utils.backoff_delay(attempt, retry_delay=5, max_delay=60)
+        assert 0 <= delay <= cap
+    assert pipeline_utils.backoff_delay(3, retry_delay=5, max_delay=60, jitter=0) == 20
+
+def test_circuit_breaker_opens_and_recovers():
+    breaker = pipeline_utils.CircuitBreaker("test", threshold=2, cooldown=60)
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.is_open()
+    breaker.opened_at -= 60
+    assert breaker.state == "half-open"
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    client = fakeredis.FakeRedis(decode_responses=True)
+    monkeypatch.setattr(pipeline_utils, "redis_client", client)
+    monkeypatch.setattr(pipeline_utils, "stream_client", client)
+    return client
+
+@pytest.fixture
+def smtp(monkeypatch):
+    for name, value in [("NOTIFY_EMAILS", "ops@example.com"), ("SMTP_SERVER", "smtp.example.com"),
+                        ("SMTP_USERNAME", "bot@example.com"), ("SMTP_PASSWORD", "secret")]:
+        monkeypatch.setattr(pipeline_utils, name, value)
+    monkeypatch.setattr(pipeline_utils, "email_breaker", pipeline_utils.CircuitBreaker("Email"))
+    smtp_class = mock.MagicMock()
+    monkeypatch.setattr(pipeline_utils.smtplib, "SMTP", smtp_class)
+    return smtp_class.return_value
+
+def run_drainer(until, timeout=5):
+    """Run the email drainer in a thread until `until()` holds, then stop it."""
+    stop = threading.Event()
+    worker = threading.Thread(target=pipeline_utils.drain_email_notifications,
+                              kwargs={"block": 10, "stop": stop})
+    worker.start()
+    deadline = time.monotonic() + timeout
+    while not until() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    stop.set()
+    worker.join(timeout)
+    assert not worker.is_alive()
+
+def test_rebuild_status_index_skips_bad_keys(fake_redis):
+    fake_redis.hset("file:a.mp3", "status", "error")
+    fake_redis.hset("file:b.mp3", "status", "queued")
+    fake_redis.set("file:not-a-hash", "x")
+    fake_redis.sadd("files:status:stale", "gone.mp3")
+    pipeline_utils.rebuild_status_index()
+    assert pipeline_utils.get_files_by_status("error") == ["a.mp3"]
+    assert pipeline_utils.get_files_by_status("queued") == ["b.mp3"]
+    assert pipeline_utils.get_files_by_status("stale") == []
+
+def test_notify_backlog_drops_when_full(monkeypatch):
+    monkeypatch.setattr(pipeline_utils, "_notify_slots", pipeline_utils.threading.BoundedSemaphore(1))
+    release = pipeline_utils.threading.Event()
+    first = pipeline_utils._submit_notification(release.wait)
+    assert pipeline_utils._submit_notification(release.wait) is None
+    release.set()
+    first.result(timeout=5)
+    assert pipeline_utils._submit_notification(release.wait) is not None
+
+def test_notify_submit_failure_releases_slot(monkeypatch):
+    class ClosedPool:
+        def submit(self, *args):
+            raise RuntimeError("cannot schedule new futures after shutdown")
+    monkeypatch.setattr(pipeline_utils, "_notify_slots", pipeline_utils.threading.BoundedSemaphore(1))
+    monkeypatch.setattr(pipeline_utils, "_notify_pool", ClosedPool())
+    assert pipeline_utils.notify_all("subject", "message") == []
+    assert pipeline_utils._notify_slots.acquire(blocking=False)
+
+def test_status_transitions_update_index(fake_redis):
+    pytest.importorskip("lupa")
+    pipeline_utils.set_file_status("a.mp3", "queued")
+    pipeline_utils.set_file_status("a.mp3", "error", error="boom", extra={"stage": "splitter"})
+    assert pipeline_utils.get_files_by_status("queued") == []
+    assert pipeline_utils.get_files_by_status("error") == ["a.mp3"]
+    assert fake_redis.hgetall("file:a.mp3") == {"status": "error", "error": "boom", "stage": "splitter"}
+
+    pipeline_utils.increment_retry("splitter", "a.mp3")
+    pipeline_utils.clear_file_error("a.mp3")
+    assert pipeline_utils.get_files_by_status("error") == []
+    assert pipeline_utils.get_files_by_status("queued") == ["a.mp3"]
+    assert fake_redis.hgetall("file:a.mp3") == {"status": "queued", "stage": "splitter"}
+    assert not fake_redis.exists("retries:a.mp3")
+
+def test_cleanup_legacy_retry_keys(fake_redis):
+    fake_redis.set("splitter_retries:a.mp3", 2)
+    fake_redis.set("metadata_retries:b.mp3", 1)
+    fake_redis.hset("retries:a.mp3", "splitter", 1)
+    fake_redis.set("upload_retries:c.mp3", 1)
+    assert pipeline_utils.cleanup_legacy_retry_keys() == 2
+    assert sorted(fake_redis.keys("*")) == ["retries:a.mp3", "upload_retries:c.mp3"]
+
+def test_drainer_sends_email_queued_before_group(fake_redis, smtp):
+    pipeline_utils.send_email("Pipeline Error", "boom")
+    run_drainer(lambda: smtp.send_message.called)
+    sent = smtp.send_message.call_args[0][0]
+    assert sent["Subject"] == "Pipeline Error"
+    assert sent.get_content().strip() == "boom"
+    assert fake_redis.xpending("stream:notifications", "email")["pending"] == 0
+
+def test_drainer_backs_off_when_redis_is_down(fake_redis, smtp, monkeypatch):
+    down = mock.Mock()
+    down.xreadgroup.side_effect = pipeline_utils.redis.exceptions.ConnectionError("refused")
+    monkeypatch.setattr(pipeline_utils, "stream_client", down)
+    sleeps = []
+    monkeypatch.setattr(pipeline_utils.time, "sleep", sleeps.append)
+    stop = threading.Event()
+    monkeypatch.setattr(pipeline_utils, "backoff_delay", lambda *a, **k: stop.set() or 1.5)
+    pipeline_utils.drain_email_notifications(block=10, stop=stop)
+    assert sleeps == [1.5]
+
+def test_drainer_drops_undeliverable_email(fake_redis, smtp):
+    pipeline_utils.send_email("too big", "x")
+    pipeline_utils.send_email("ok", "y")
+    def send_message(msg):
+        if msg["Subject"] == "too big":
+            raise pipeline_utils.smtplib.SMTPDataError(552, b"message too big")
+    smtp.send_message.side_effect = send_message
+    pipeline_utils.email_breaker.threshold = 100
+    run_drainer(lambda: any(c[0][0]["Subject"] == "ok" for c in smtp.send_message.call_args_list))
+    subjects = [c[0][0]["Subject"] for c in smtp.send_message.call_args_list]
+    assert subjects == ["too big"] * 5 + ["ok"]
+    assert fake_redis.xpending("stream:notifications", "email")["pending"] == 0
+
+def test_send_email_queues_only_with_smtp_config(fake_redis, smtp, monkeypatch):
+    pipeline_utils.send_email("Pipeline Error", "boom")
+    [(_, fields)] = fake_redis.xrange("stream:notifications")
+    assert fields == {"channel": "email", "subject": "Pipeline Error", "body": "boom"}
+    monkeypatch.setattr(pipeline_utils, "SMTP_PASSWORD", None)
+    pipeline_utils.send_email("Pipeline Error", "boom")
+    assert fake_redis.xlen("stream:notifications") == 1
+    smtp.send_message.assert_not_called()
+
+def test_drainer_leaves_unsent_email_pending(fake_redis, smtp, monkeypatch):
+    refused = mock.Mock(side_effect=ConnectionRefusedError("smtp down"))
+    monkeypatch.setattr(pipeline_utils.smtplib, "SMTP", refused)
+    pipeline_utils.send_email("Pipeline Error", "boom")
+    run_drainer(lambda: refused.call_count >= 2)
+    assert fake_redis.xpending("stream:notifications", "email")["pending"] == 1
+
+def test_drainer_resends_pending_email_on_startup(fake_redis, smtp):
+    pipeline_utils.send_email("Pipeline Error", "boom")
+    pipeline_utils.ensure_consumer_group("stream:notifications", "email", id="0")
+    # a previous drainer read the entry but died before sending it
+    assert pipeline_utils.consume("stream:notifications", "email", "email-drainer", block=10)
+    run_drainer(lambda: smtp.send_message.called)
+    assert smtp.send_message.call_args[0][0]["Subject"] == "Pipeline Error"
+    assert fake_redis.xpending("stream:notifications", "email")["pending"] == 0
+
+def test_drainer_acks_trimmed_pending_entries(fake_redis, smtp):
+    pipeline_utils.send_email("Pipeline Error", "boom")
+    pipeline_utils.ensure_consumer_group("stream:notifications", "email", id="0")
+    [(msg_id, _)] = pipeline_utils.consume("stream:notifications", "email", "email-drainer", block=10)
+    fake_redis.xdel("stream:notifications", msg_id)
+    run_drainer(lambda: fake_redis.xpending("stream:notifications", "email")["pending"] == 0)
+    assert fake_redis.xpending("stream:notifications", "email")["pending"] == 0
+    smtp.send_message.assert_not_called()
+
+def test_read_group_maps_trimmed_entries_to_empty_data(monkeypatch):
+    # real Redis returns nil fields for pending entries trimmed from the stream
+    client = mock.Mock()
+    client.xreadgroup.return_value = [["stream:notifications", [("1-0", None), ("2-0", {"a": "b"})]]]
+    monkeypatch.setattr(pipeline_utils, "stream_client", client)
+    assert pipeline_utils._read_group("stream:notifications", "email", "c", last_id="0") == [
+        ("1-0", {}), ("2-0", {"a": "b"})]
+
 # Add more unit tests for each public function